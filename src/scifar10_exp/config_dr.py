@@ -44,6 +44,8 @@ data_config = OrderedDict([
         normalize,
         transforms.Normalize(np.array([0.1307]), np.array([0.3081]))
     ])),
+    ('pretensorize', True),  # Apply the (deterministic) transforms once and keep each split as a tensor
+    ('cache_dir', None),  # Directory of the on-disk cache of pre-tensorized splits (None: no cache)
 ])
 
 
@@ -54,7 +56,17 @@ run_config = OrderedDict([
     #('tasks', [[0, 1], [2, 3]]),
     ('seed', 1234),
     # Added config to set Distribution Matching
-    ('distillation_method', None) # 'DM' for our Distribution Matching approach. Else: Original method.
+    ('distillation_method', None), # 'DM' for our Distribution Matching approach, 'EDM' for embedding distribution matching, 'KRR' for kernel ridge regression. Else: Original method.
+    ('init_bank', None),  # Directory of the memory-mapped initialization bank (None: inits are generated on the fly)
+    ('fused_eval', True),  # Evaluate all the seen tasks in one batched pass
+    ('async_eval', False),  # Evaluate snapshots of the weights in a background thread while training continues
+    ('precision', 'fp32'),  # 'bf16' for bfloat16 autocast of training, evaluation and distillation (fp32 master weights)
+    ('pipeline_distill', False),  # Distill the buffer of each task in a separate process while training on the task continues
+    ('pipeline_threads', None),  # Threads of the distillation process with pipeline_distill, training keeps the other cores (None: half of the cores)
+    ('checkpoint_dir', None),  # Directory of the experiment checkpoints (None: no checkpoints)
+    ('checkpoint_every', 5),  # Distillation outer steps between checkpoints of the distillation state (0: none)
+    ('checkpoint_train_every', 1),  # Training epochs between checkpoints of the training state (0: only at the start of each task)
+    ('resume', False),  # Restart from the latest checkpoint in checkpoint_dir
 ])
 
 log_config = OrderedDict([
@@ -75,7 +87,30 @@ param_config = OrderedDict([
     ('batch_size', 128),  # Minibatch size used during distillation
     ('distill_batch_size', 128),
     ('buffer_size', 1),  # Number of examples per class kept in the buffer
-    ('n_inits', 5) # Number of model initializations for gradient matching
+    ('n_inits', 5), # Number of model initializations for gradient matching
+    ('dm_first_order', True),  # Real data gradients are computed without graph (they are constant targets)
+    ('dm_cache_real_grads', False),  # Keep the first epoch real batches fixed and reuse their gradients (memory: n_inits gradients, times the classes with dm_classwise, of every real batch: about 10 GB for cnn2 on a task of sCIFAR10)
+    ('dm_classwise', False),  # Match the synthetic gradients of each class against real data of that class only
+    ('init_bank_size', 100),  # Number of initializations in the bank (the first 10 are used for validation)
+    ('init_bank_dtype', 'float32'),  # 'float32' or 'float16'
+    ('eval_batch_size', 1024),  # Minibatch size of the fused evaluation
+    ('train_steps_per_call', 8),  # Optimizer steps run by each call to Train (they never cross a logging checkpoint)
+    ('distill_checkpoint_segment', 0),  # Inner steps per checkpointed segment of the unroll (0: no checkpointing)
+    ('distill_truncate', None),  # Backpropagate only through the last K inner steps (None: all of them)
+    ('distill_inits', 1),  # Initializations unrolled together (vectorized) at each step of the original method
+    ('distill_eval_points', 20),  # Evaluations of the buffer during the original distillation (0: no evaluation)
+    ('distill_eval_samples', None),  # Samples per class of the fixed train/valid subsets used by those evaluations (None: whole sets)
+    ('krr_kernel', 'rf'),  # Kernel of the 'KRR' method: 'rf' (random network features) or 'ntk' (empirical NTK)
+    ('krr_ridge', 1e-3),  # Ridge of the 'KRR' method (relative to the mean of the kernel diagonal)
+    ('distill_shard', 'batch'),  # Distributed distillation (torchrun, gloo backend): each worker takes a shard of every real minibatch ('batch') or its own initializations ('inits')
+    ('distill_patience', None),  # Stop distilling after this many outer steps without improvement of the objective (None: always run outer_steps)
+    ('distill_min_delta', 0.0),  # Minimum decrease of the smoothed objective counted as an improvement
+    ('distill_smoothing', 1),  # Outer steps averaged to smooth the objective
+    ('replay_policy', 'even'),  # Minibatch composition: 'even' (current task and each memory alike), 'ratio' or 'quota' (bounded replay)
+    ('replay_ratio', 0.5),  # Fraction of the minibatch given to the memories by the 'ratio' policy (maximum for 'quota')
+    ('replay_quota', 16),  # Samples of each memory in the minibatch with the 'quota' policy
+    ('memory_dtype', 'float32'),  # Storage of the memories: 'float32', 'float16' or 'uint8' (dequantized when replayed)
+    ('buffer_init', 'random'),  # Initial buffer images: 'random', 'herding' or 'kcenter' (coresets of the embeddings of the model)
 ])
 
 config = OrderedDict([
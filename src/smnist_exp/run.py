@@ -1,15 +1,24 @@
 import copy
+import functools
+import hashlib
+import inspect
+import multiprocessing
+import os
+import queue
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import torch
-import higher
 import wandb
 
 import contflame.data.datasets as datasets
-from contflame.data.utils import MultiLoader, Buffer
 from torch import nn
 import numpy as np
 from torch import autograd
+from torch.func import functional_call, grad, vmap
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import DataLoader, IterableDataset
 
 import time
@@ -64,41 +73,51 @@ class Train:
         self.train_loader = train_loader
         self.iter = enumerate(train_loader)
 
-    def __call__(self, model):
+        # Running metrics, accumulated on the device until they are logged
+        self.loss_sum = 0
+        self.correct = 0
+        self.tot = 0
+
+    def __call__(self, model, steps=1):
         model.train()
 
         run_config = self.config['run_config']
 
-        correct = 0
-        loss_sum = 0
-        tot = 0
+        for _ in range(steps):
+            try:
+                step, (data, targets) = next(self.iter)
+            except StopIteration:
+                self.iter = enumerate(self.train_loader)
+                step, (data, targets) = next(self.iter)
 
-        try:
-            step, (data, targets) = next(self.iter)
-        except StopIteration:
-            self.iter = enumerate(self.train_loader)
-            step, (data, targets) = next(self.iter)
+            data = data.to(run_config['device'])
+            targets = targets.to(run_config['device'])
+            self.optimizer.zero_grad()
 
-        data = data.to(run_config['device'])
-        targets = targets.to(run_config['device'])
-        self.optimizer.zero_grad()
+            with autocast(run_config['device'], run_config['precision']):
+                outputs = model(data)
+                loss = self.criterion(outputs, targets)
+            loss.backward()
 
-        outputs = model(data)
-        loss = self.criterion(outputs, targets)
-        loss.backward()
+            self.optimizer.step()
 
-        self.optimizer.step()
+            _, preds = torch.max(outputs, dim=1)
 
-        _, preds = torch.max(outputs, dim=1)
+            self.loss_sum += loss.detach() * data.size(0)
+            self.correct += preds.eq(targets).sum()
+            self.tot += data.size(0)
 
-        loss_sum += loss.item() * data.size(0)
-        correct += preds.eq(targets).sum().item()
-        tot += data.size(0)
+    def metrics(self):
+        """Loss and accuracy of the steps since the last call (one host sync)."""
+        loss_sum, correct = torch.stack((torch.as_tensor(self.loss_sum, dtype=torch.float),
+                                         torch.as_tensor(self.correct, dtype=torch.float))).tolist()
+        tot = max(self.tot, 1)
 
-        accuracy = correct / tot
-        loss = loss_sum / tot
+        self.loss_sum = 0
+        self.correct = 0
+        self.tot = 0
 
-        return loss, accuracy
+        return loss_sum / tot, correct / tot
 
 def test(model, criterion, test_loader, config):
     model.eval()
@@ -111,7 +130,7 @@ def test(model, criterion, test_loader, config):
         data = data.to(config['device'])
         targets = targets.to(config['device'])
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast(config['device'], config['precision']):
             outputs = model(data)
             loss = criterion(outputs, targets)
 
@@ -127,6 +146,163 @@ def test(model, criterion, test_loader, config):
     return loss, accuracy
 
 
+def validate(model, criterion, validloaders, evaluator, config):
+    """Test metrics of every task seen so far (with the fused evaluator when available)."""
+    if evaluator is not None:
+        return evaluator(model)
+
+    valid_m = {'Test accuracy avg': 0}
+    for i, vl in enumerate(validloaders):
+        test_loss, test_accuracy = test(model, criterion, vl, config)
+        valid_m = {**valid_m, **{f'Test loss {i}': test_loss,
+                   f'Test accuracy {i}': test_accuracy,}}
+        valid_m['Test accuracy avg'] += (test_accuracy / len(validloaders))
+    return valid_m
+
+
+def log_metrics(metrics, log_config):
+    if log_config['print']:
+        print(metrics)
+    if log_config['wandb']:
+        wandb.log(metrics)
+
+
+class AsyncEvaluator:
+    """
+    Evaluates snapshots of the model's weights in a background thread (with its own copy of the model),
+    so that training does not stop at every checkpoint. Results are logged as they complete.
+    """
+
+    def __init__(self, net, log_config):
+        self.model = copy.deepcopy(net)
+        self.log_config = log_config
+        self.queue = queue.Queue(maxsize=2)  # Training blocks if evaluation falls too far behind
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, net, evaluate, train_m):
+        snapshot = {k: v.detach().clone() for k, v in net.state_dict().items()}
+        self.queue.put((snapshot, evaluate, train_m))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+
+            snapshot, evaluate, train_m = item
+            try:
+                self.model.load_state_dict(snapshot)
+                log_metrics({**evaluate(self.model), **train_m}, self.log_config)
+            except Exception as e:
+                self.error = e
+
+
+class FusedEvaluator:
+    """
+    Evaluates every task seen so far in one pass over their concatenated validation sets:
+    losses and accuracies are split per task on the device, with a single host sync.
+    """
+
+    def __init__(self, batch_size, device, precision='fp32'):
+        self.batch_size = batch_size
+        self.device = device
+        self.precision = precision
+        self.data = self.targets = self.tasks = None
+        self.n_tasks = 0
+
+    def add(self, validset):
+        if not isinstance(validset, TensorSplit):
+            validset = TensorSplit.from_dataset(validset)
+        data, targets = validset.data.to(self.device), validset.targets.to(self.device)
+        tasks = torch.full_like(targets, self.n_tasks)
+
+        self.data = data if self.data is None else torch.cat((self.data, data))
+        self.targets = targets if self.targets is None else torch.cat((self.targets, targets))
+        self.tasks = tasks if self.tasks is None else torch.cat((self.tasks, tasks))
+        self.n_tasks += 1
+
+    def __call__(self, model):
+        model.eval()
+
+        loss_sum = torch.zeros(self.n_tasks, device=self.device)
+        correct = torch.zeros(self.n_tasks, device=self.device)
+        tot = torch.bincount(self.tasks, minlength=self.n_tasks)
+
+        with torch.no_grad(), autocast(self.device, self.precision):
+            for start in range(0, self.data.size(0), self.batch_size):
+                data = self.data[start:start + self.batch_size]
+                targets = self.targets[start:start + self.batch_size]
+                tasks = self.tasks[start:start + self.batch_size]
+
+                outputs = model(data)
+                loss = nn.functional.cross_entropy(outputs, targets, reduction='none')
+                _, preds = torch.max(outputs, dim=1)
+
+                loss_sum.index_add_(0, tasks, loss.float())
+                correct.index_add_(0, tasks, preds.eq(targets).float())
+
+        losses, accuracies = torch.stack((loss_sum / tot, correct / tot)).tolist()
+
+        metrics = {'Test accuracy avg': sum(accuracies) / self.n_tasks}
+        for i, (test_loss, test_accuracy) in enumerate(zip(losses, accuracies)):
+            metrics = {**metrics, **{f'Test loss {i}': test_loss,
+                       f'Test accuracy {i}': test_accuracy,}}
+        return metrics
+
+def load_split(Dataset, config, dset, transform, classes):
+    """Task split of the dataset, pre-tensorized (and cached on disk) if required by the config."""
+    data_config = config['data_config']
+
+    # Pre-tensorized splits are cached by dataset, split, classes and transform
+    cache_dir = data_config['cache_dir'] if data_config['pretensorize'] else None
+    if cache_dir is not None:
+        key = hashlib.sha1(repr((data_config['dataset'], dset, data_config['valid'], sorted(classes),
+                                 transform_fingerprint(transform))).encode()).hexdigest()[:16]
+        name = f"{data_config['dataset']}_{dset}_{'-'.join(map(str, sorted(classes)))}_{key}"
+        ds = TensorSplit.load(cache_dir, name)
+        if ds is not None:
+            return ds
+
+    ds = Dataset(dset=dset, valid=data_config['valid'], transform=transform, classes=classes)
+    if data_config['pretensorize']:
+        ds = TensorSplit.from_dataset(ds, data_config['num_workers'])
+        if cache_dir is not None:
+            ds.save(cache_dir, name)
+    return ds
+
+
+def transform_fingerprint(transform):
+    """Stable description of a transform pipeline (functions are described by their source code)."""
+    parts = []
+    for t in getattr(transform, 'transforms', [transform]):
+        if inspect.isfunction(t):
+            try:
+                code = inspect.getsource(t)
+            except (OSError, TypeError):
+                code = t.__code__.co_code.hex()
+            parts.append(f'{t.__qualname__}: {code}')
+        else:
+            parts.append(repr(t))
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+def make_loader(dataset, batch_size, shuffle, config):
+    """DataLoader of the dataset (served by tensor indexing on the device when it is pre-tensorized)."""
+    if isinstance(dataset, TensorSplit):
+        return TensorLoader(dataset, batch_size, shuffle, config['run_config']['device'])
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=True, num_workers=config['data_config']['num_workers'])
+
+
 def run(config):
 
     run_config = config['run_config']
@@ -135,6 +311,23 @@ def run(config):
     data_config = config['data_config']
     log_config = config['log_config']
 
+    # Distributed distillation (launched with torchrun): the first worker runs the experiment and logs, the others
+    # only join its distillations, each worker with its share of the cores
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not torch.distributed.is_initialized():
+        if run_config['pipeline_distill']:
+            raise ValueError('pipeline_distill is not supported with distributed distillation')
+        torch.distributed.init_process_group('gloo')
+    rank, world = dist_info()
+    distill_threads = max(os.cpu_count() // world, 1) if world > 1 else torch.get_num_threads()
+    if rank != 0:
+        config['log_config'] = {**log_config, 'wandb': False, 'print': False}
+        torch.set_num_threads(distill_threads)
+        distill_worker(config)
+        torch.distributed.destroy_process_group()
+        return
+    if world > 1:
+        torch.set_num_threads(os.cpu_count())  # torchrun starts every worker with one thread
+
     if log_config['wandb']:
         wandb.init(project="smnist", name=log_config['wandb_name'])
         wandb.config.update(config)
@@ -157,26 +350,76 @@ def run(config):
     # Data
     Dataset = getattr(datasets, data_config['dataset'])
 
+    start_time = time.time()
+
     # Training
     memories = []
     validloaders = []
+    evaluator = FusedEvaluator(param_config['eval_batch_size'], run_config['device'], run_config['precision']) if run_config['fused_eval'] else None
+    async_eval = AsyncEvaluator(net, log_config) if run_config['async_eval'] else None
+    # Pipelined distillation: the buffer of task t is distilled in another process while training on task t,
+    # the cores are split between the two processes
+    pipeline = None
+    if run_config['pipeline_distill']:
+        child_threads = run_config['pipeline_threads'] or max(os.cpu_count() // 2, 1)
+        pipeline = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=torch.set_num_threads, initargs=(child_threads,))
+        torch.set_num_threads(max(os.cpu_count() - child_threads, 1))
+    pending = None
     s = 0
 
-    for task_id, task in enumerate(run_config['tasks'], 0):
-        validset = Dataset(dset='test', valid=data_config['valid'], transform=data_config['test_transform'], classes=task)
-        validloaders.append(DataLoader(validset, batch_size=param_config['batch_size'], shuffle=False, pin_memory=True, num_workers=data_config['num_workers']))
-        trainset = Dataset(dset='train', valid=data_config['valid'], transform=data_config['train_transform'], classes=task)
+    # Resume from the latest checkpoint (the tasks before it are only added to the evaluation)
+    checkpointer = Checkpointer(config)
+    state = checkpointer.load('run')
+    if state is not None:
+        net.load_state_dict(state['net'])
+        memories = [TensorBuffer(*memory) for memory in state['memories']]
+        s = state['s']
 
-        # Add pin_memory=True to ALL DataLoaders
-        bufferloader = MultiLoader([trainset] + memories, batch_size=param_config['batch_size'], 
-                                pin_memory=True)
+    for task_id, task in enumerate(run_config['tasks'], 0):
+        validset = load_split(Dataset, config, 'test', data_config['test_transform'], task)
+        validloaders.append(make_loader(validset, param_config['batch_size'], False, config))
+        if evaluator is not None:
+            evaluator.add(validset)
+        if state is not None and task_id < state['task_id']:
+            continue
+        trainset = load_split(Dataset, config, 'train', data_config['train_transform'], task)
+
+        # The buffer of the previous task is needed from now on
+        if pending is not None:
+            memories.append(join_memory(pending.result(), config, task_id - 1))
+            pending = None
+
+        # Checkpoint at the start of the task, or resume the checkpointed task ('train' phase: from its training
+        # step 'step', 'distill' phase: trained already, from its distillation)
+        resumed, state = state, None
+        if resumed is None:
+            checkpointer.save('run', {'task_id': task_id, 'phase': 'train', 'step': 0, 'net': net.state_dict(), 'd_net': net.state_dict(),
+                                      's': s, 'rng': get_rng_state(), 'memories': [buffer_to_tensors(memory) for memory in memories]})
+            checkpointer.remove(f'distill_{task_id - 1}')
+        elif resumed['phase'] == 'train':
+            set_rng_state(resumed['rng'])
+        distilling = resumed is not None and resumed['phase'] == 'distill'
+
+        # Current task minibatches with the replay of all the memories fused in
+        bufferloader = ReplayLoader(trainset, memories, param_config['batch_size'], config)
+        log_metrics({f'Replay current task samples {task_id}': bufferloader.train_size,
+                     f'Replay memory samples {task_id}': sum(bufferloader.quotas),
+                     f'Replay steps per epoch {task_id}': len(bufferloader)}, log_config)
 
         optimizer = torch.optim.SGD(net.parameters(), lr=param_config['model_lr'], )
         train = Train(optimizer, criterion, bufferloader, config)
 
         d_net = copy.deepcopy(net)
-        d_trainloader = DataLoader(trainset, batch_size=param_config['distill_batch_size'], shuffle=True, pin_memory=True, num_workers=data_config['num_workers'])
-        d_validloader = DataLoader(validset, batch_size=param_config['distill_batch_size'], shuffle=False, pin_memory=True, num_workers=data_config['num_workers'])
+        if resumed is not None:
+            d_net.load_state_dict(resumed['d_net'])
+        distill_now = task_id != len(run_config['tasks']) - 1 and param_config['buffer_size'] != 0
+        if pipeline is not None and distill_now:
+            # The child process gets a CPU copy of the model and does not log to wandb
+            child_config = {**config, 'log_config': {**log_config, 'wandb': False}}
+            buffer = TensorBuffer(*resumed['buffer']) if distilling else make_buffer(Dataset, config, task, d_net)
+            pending = pipeline.submit(distill_task, copy.deepcopy(d_net).cpu(), buffer, trainset, validset,
+                                      child_config, task_id, seed + task_id)
 
         if param_config['step'] == 'epoch':
             steps = len(bufferloader) * param_config['no_steps']
@@ -184,138 +427,616 @@ def run(config):
             steps = param_config['no_steps']
         else:
             raise ValueError
+        if distilling:
+            steps = 0
 
-        for step in range(steps):
-
-            buffer_loss, buffer_accuracy = train(net)
+        # Training checkpoints at epoch ends, where the next minibatches only depend on the RNG state
+        checkpoint_steps = len(bufferloader) * run_config['checkpoint_train_every']
 
-            if (int(steps * 0.05) <= 0 or step % int(steps * 0.05) == int(steps * 0.05) - 1 or step == 0):
-                valid_m = {'Test accuracy avg': 0}
-                for i, vl in enumerate(validloaders):
-                    test_loss, test_accuracy = test(net, criterion, vl, run_config)
-                    valid_m = {**valid_m, **{f'Test loss {i}': test_loss,
-                               f'Test accuracy {i}': test_accuracy,}}
-                    valid_m['Test accuracy avg'] += (test_accuracy / len(validloaders))
+        log_every = int(steps * 0.05)
+        step = resumed['step'] if resumed is not None and not distilling else 0
+        while step < steps:
 
+            # Several optimizer steps per call, without going past the next logged step or training checkpoint
+            if log_every <= 0 or step == 0:
+                n = 1
+            else:
+                n = min(param_config['train_steps_per_call'], (log_every - 1 - step) % log_every + 1, steps - step)
+            if checkpoint_steps > 0:
+                n = min(n, checkpoint_steps - step % checkpoint_steps)
+            train(net, n)
+            step += n
+
+            if (log_every <= 0 or (step - 1) % log_every == log_every - 1 or step == 1):
+                buffer_loss, buffer_accuracy = train.metrics()
                 train_m = {f'Buffer loss': buffer_loss,
                            f'Buffer accuracy': buffer_accuracy,
                            f'Step': s}
                 s += 1
-                if log_config['print']:
-                    print({**valid_m, **train_m})
-                if log_config['wandb']:
-                    wandb.log({**valid_m, **train_m})
+
+                if async_eval is not None:
+                    # The tasks seen so far are frozen with the snapshot of the weights
+                    async_eval.submit(net, functools.partial(validate, criterion=criterion, validloaders=list(validloaders),
+                                                             evaluator=copy.copy(evaluator), config=run_config), train_m)
+                else:
+                    valid_m = validate(net, criterion, validloaders, evaluator, run_config)
+                    log_metrics({**valid_m, **train_m}, log_config)
+
+            if checkpoint_steps > 0 and step % checkpoint_steps == 0 and step < steps:
+                checkpointer.save('run', {'task_id': task_id, 'phase': 'train', 'step': step, 'net': net.state_dict(), 'd_net': d_net.state_dict(),
+                                          's': s, 'rng': get_rng_state(), 'memories': [buffer_to_tensors(memory) for memory in memories]})
 
         if task_id == len(run_config['tasks']) - 1:
             break
 
-        if param_config['buffer_size'] != 0:
-            buffer = None
-            for t in task:
-                ds = Dataset(dset='train', valid=data_config['valid'], transform=data_config['test_transform'], classes=[t])
-                buffer = Buffer(ds, param_config['buffer_size']) if buffer is None else buffer + Buffer(ds, param_config['buffer_size'])
-
-            if log_config['wandb']:
-                mean, std = data_config['test_transform'].transforms[-1].mean, data_config['test_transform'].transforms[-1].std
-                x, y = next(iter(DataLoader(buffer, batch_size=len(buffer), shuffle=False)))
-                print_images(x[:1], y[:-1], mean, std)
-                print_images(x[1:], y[-1:], mean, std)
-
-            # Added Distribution Matching option
-            if run_config['distillation_method'] == 'DM': 
-                start_time = time.time()
-                buffer, _ = distill_dm(d_net, buffer, config, criterion, d_trainloader)
-                end_time = time.time()
+        if pipeline is None and distill_now:
+            if distilling:
+                buffer = TensorBuffer(*resumed['buffer'])
+                set_rng_state(resumed['rng'])
             else:
-                start_time = time.time()
-                buffer, _ = distill(d_net, buffer, config, criterion, d_trainloader, d_validloader, task_id)
-                end_time = time.time()
+                buffer = make_buffer(Dataset, config, task, d_net)
+                checkpointer.save('run', {'task_id': task_id, 'phase': 'distill', 'net': net.state_dict(), 'd_net': d_net.state_dict(),
+                                          'buffer': buffer_to_tensors(buffer), 's': s, 'rng': get_rng_state(),
+                                          'memories': [buffer_to_tensors(memory) for memory in memories]})
+            if world > 1:
+                # The other workers join the distillation with the same model, buffer and RNG state
+                buffer = TensorBuffer(*buffer_to_tensors(buffer))
+                torch.distributed.broadcast_object_list([(task_id, copy.deepcopy(d_net).cpu(), buffer, get_rng_state())], src=0)
+            threads = torch.get_num_threads()
+            torch.set_num_threads(distill_threads)
+            buffer = distill_task(d_net, buffer, trainset, validset, config, task_id)
+            torch.set_num_threads(threads)
+            memories.append(join_memory(buffer, config, task_id))
+
+    if async_eval is not None:
+        async_eval.close()
+    if pipeline is not None:
+        pipeline.shutdown()
+    if world > 1:
+        torch.distributed.broadcast_object_list([None], src=0)
+        torch.distributed.destroy_process_group()
+
+    # Summary of the run, to compare the accuracy, wall-clock time and memory size of each precision and memory dtype
+    final_m = validate(net, criterion, validloaders, evaluator, run_config)
+    memory_bytes = sum(memory.imgs.numel() * memory.imgs.element_size() for memory in memories)
+    memory_fp32 = sum(memory.imgs.numel() * 4 for memory in memories)
+    log_metrics({'Precision': run_config['precision'],
+                 'Memory dtype': param_config['memory_dtype'],
+                 'Final test accuracy avg': final_m['Test accuracy avg'],
+                 'Memory size (MB)': memory_bytes / 2 ** 20,
+                 'Memory saved (MB)': (memory_fp32 - memory_bytes) / 2 ** 20,
+                 'Wall-clock time (s)': time.time() - start_time}, log_config)
+
+class Checkpointer:
+    """
+    Experiment state saved in run_config['checkpoint_dir'] (nothing is saved if it is None): the latest state of run()
+    and, every 'checkpoint_every' outer steps, the state of the distillation in progress. With run_config['resume']
+    the experiment restarts from them.
+    """
+
+    def __init__(self, config):
+        run_config = config['run_config']
+        self.path = run_config['checkpoint_dir']
+        self.every = run_config['checkpoint_every']
+        self.resume = run_config['resume']
+
+    def save(self, name, state):
+        if self.path is None or dist_info()[0] != 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        file = os.path.join(self.path, f'{name}.pt')
+        tmp = f'{file}.{os.getpid()}.tmp'
+        torch.save(state, tmp)
+        os.replace(tmp, file)  # Atomic, so that a crash while saving keeps the previous checkpoint
+
+    def load(self, name):
+        """Saved state (None if it does not exist or the run is not resumed)."""
+        if self.path is None or not self.resume:
+            return None
+        file = os.path.join(self.path, f'{name}.pt')
+        if not os.path.exists(file):
+            return None
+        return torch.load(file, map_location='cpu', weights_only=False)
+
+    def remove(self, name):
+        if self.path is None or dist_info()[0] != 0:
+            return
+        file = os.path.join(self.path, f'{name}.pt')
+        if os.path.exists(file):
+            os.remove(file)
+
+    def save_distill(self, id, step, buff_imgs, buff_opt, stopper, **state):
+        """Saves the distillation state of task id after outer step 'step' (every 'checkpoint_every' of them)."""
+        if self.path is None or self.every <= 0 or (step + 1) % self.every != 0:
+            return
+        self.save(f'distill_{id}', {'outer_step': step, 'buff_imgs': buff_imgs.detach().cpu(), 'buff_opt': buff_opt.state_dict(),
+                                    'stopper': stopper.state_dict(), 'rng': get_rng_state(), **state})
+
+    def load_distill(self, id, buff_imgs, buff_opt, stopper):
+        """Restores the interrupted distillation of task id, returning its state (None if there is none)."""
+        state = self.load(f'distill_{id}')
+        if state is not None:
+            with torch.no_grad():
+                buff_imgs.copy_(state['buff_imgs'])
+            buff_opt.load_state_dict(state['buff_opt'])
+            stopper.load_state_dict(state['stopper'])
+            set_rng_state(state['rng'])
+        return state
+
+
+def get_rng_state():
+    return {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def buffer_to_tensors(buffer):
+    """Images and targets of a buffer as two tensors (without copies for a TensorBuffer)."""
+    if isinstance(buffer, TensorBuffer):
+        return buffer.imgs, buffer.trgs
+    imgs, trgs = zip(*(buffer[i] for i in range(len(buffer))))
+    return torch.stack(imgs), torch.stack([torch.as_tensor(t) for t in trgs])
+
+
+def make_buffer(Dataset, config, task, d_net):
+    """
+    Buffer of 'buffer_size' examples of each class of the task, chosen as set by 'buffer_init': 'random', or a
+    coreset of the embeddings of d_net ('herding' or 'kcenter').
+    """
+    data_config = config['data_config']
+    param_config = config['param_config']
 
-            print(f"*******************Time in {task_id}: {end_time-start_time}")
-            
+    buffer = None
+    for t in task:
+        ds = load_split(Dataset, config, 'train', data_config['test_transform'], [t])
+        if param_config['buffer_init'] == 'random':
+            part = TensorBuffer.from_dataset(ds, param_config['buffer_size'])
+        else:
+            part = coreset_buffer(ds, param_config['buffer_size'], d_net, param_config['buffer_init'], config)
+        buffer = part if buffer is None else buffer + part
 
+    if config['log_config']['wandb']:
+        mean, std = data_config['test_transform'].transforms[-1].mean, data_config['test_transform'].transforms[-1].std
+        x, y = buffer_to_tensors(buffer)
+        print_images(x[:1], y[:-1], mean, std)
+        print_images(x[1:], y[-1:], mean, std)
 
-            if log_config['wandb']:
-                mean, std = data_config['test_transform'].transforms[-1].mean, data_config['test_transform'].transforms[-1].std
-                x, y = next(iter(DataLoader(buffer, batch_size=len(buffer), shuffle=False)))
-                print_images(x[:1], y[:1], mean, std)
-                print_images(x[-1:], y[-1:], mean, std)
+    return buffer
 
-            memories.append(buffer)
 
-def distill_dm(model, buffer, config, criterion, train_loader):
+def coreset_buffer(ds, dim, model, method, config):
+    """dim examples of ds selected by herding or k-center greedy on their embeddings (input of the last linear layer of model)."""
+    run_config = config['run_config']
+    batch_size = config['param_config']['eval_batch_size']
+
+    candidates = TensorBuffer.from_dataset(ds, -1)
+    model = copy.deepcopy(model).to(run_config['device']).eval()
+    classifier = [module for module in model.modules() if isinstance(module, nn.Linear)][-1]
+    emb = []
+    handle = classifier.register_forward_pre_hook(lambda module, inputs: emb.append(inputs[0].flatten(1)))
+    try:
+        with torch.no_grad():
+            for start in range(0, len(candidates), batch_size):
+                model(candidates.imgs[start:start + batch_size].to(run_config['device']))
+    finally:
+        handle.remove()
+    emb = torch.cat(emb)
+
+    dim = min(dim, emb.size(0)) if dim >= 0 else emb.size(0)
+    if method == 'herding':
+        idx = herding(emb, dim)
+    elif method == 'kcenter':
+        idx = kcenter_greedy(emb, dim)
+    else:
+        raise ValueError(f'Unknown buffer init {method}')
+
+    idx = idx.cpu()
+    return TensorBuffer(candidates.imgs[idx], candidates.trgs[idx])
+
+
+def herding(emb, n):
+    """Indices of n rows of emb whose running mean stays the closest to the mean of all of them."""
+    mean = emb.mean(0)
+    selected = torch.zeros(emb.size(0), dtype=torch.bool, device=emb.device)
+    total = torch.zeros_like(mean)
+    idx = []
+    for k in range(n):
+        dist = torch.linalg.vector_norm(mean - (total + emb) / (k + 1), dim=1)
+        dist[selected] = float('inf')
+        i = dist.argmin()
+        idx.append(i)
+        selected[i] = True
+        total += emb[i]
+    return torch.stack(idx) if idx else torch.zeros(0, dtype=torch.long)
+
+
+def kcenter_greedy(emb, n):
+    """Indices of n rows of emb chosen greedily as the farthest from those already chosen (starting from the closest to the mean)."""
+    if n == 0:
+        return torch.zeros(0, dtype=torch.long)
+    first = torch.linalg.vector_norm(emb - emb.mean(0), dim=1).argmin()
+    min_dist = torch.linalg.vector_norm(emb - emb[first], dim=1)
+    idx = [first]
+    for _ in range(n - 1):
+        i = min_dist.argmax()
+        idx.append(i)
+        min_dist = torch.minimum(min_dist, torch.linalg.vector_norm(emb - emb[i], dim=1))
+    return torch.stack(idx)
+
+
+def distill_worker(config):
+    """
+    Other workers of a distributed distillation: they distill the buffers sent by the first worker, starting from
+    its model and RNG state so that all the workers run in lockstep, until it sends None.
+    """
+    data_config = config['data_config']
+    Dataset = getattr(datasets, data_config['dataset'])
+
+    while True:
+        job = [None]
+        torch.distributed.broadcast_object_list(job, src=0)
+        if job[0] is None:
+            return
+        task_id, d_net, buffer, rng = job[0]
+        task = config['run_config']['tasks'][task_id]
+        trainset = load_split(Dataset, config, 'train', data_config['train_transform'], task)
+        validset = load_split(Dataset, config, 'test', data_config['test_transform'], task)
+        set_rng_state(rng)
+        distill_task(d_net.to(device), buffer, trainset, validset, config, task_id)
+
+
+def distill_task(d_net, buffer, trainset, validset, config, task_id, seed=None):
+    """
+    Distills the buffer of a task with the configured method (d_net is the model before training on the task).
+    It only takes picklable arguments, so that it can run in a separate process (seeded with seed, if given).
+    """
+    run_config = config['run_config']
+    param_config = config['param_config']
+
+    if seed is not None:
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        random.seed(seed)
+
+    criterion = nn.CrossEntropyLoss()
+    d_trainloader = make_loader(trainset, param_config['distill_batch_size'], True, config)
+    d_validloader = make_loader(validset, param_config['distill_batch_size'], False, config)
+
+    # Added Distribution Matching option
+    if run_config['distillation_method'] == 'DM': 
+        start_time = time.time()
+        buffer, _ = distill_dm(d_net, buffer, config, criterion, d_trainloader, task_id)
+        end_time = time.time()
+    elif run_config['distillation_method'] == 'EDM':
+        start_time = time.time()
+        buffer, _ = distill_edm(d_net, buffer, config, d_trainloader, task_id)
+        end_time = time.time()
+    elif run_config['distillation_method'] == 'KRR':
+        start_time = time.time()
+        buffer, _ = distill_krr(d_net, buffer, config, d_trainloader, task_id)
+        end_time = time.time()
+    else:
+        start_time = time.time()
+        buffer, _ = distill(d_net, buffer, config, criterion, d_trainloader, d_validloader, task_id)
+        end_time = time.time()
+
+    print(f"*******************Time in {task_id}: {end_time-start_time}")
+
+    return buffer
+
+
+def join_memory(buffer, config, task_id):
+    """Distilled buffer of task task_id, ready to be appended to the memories (in their storage format)."""
+    data_config = config['data_config']
+
+    if config['log_config']['wandb']:
+        mean, std = data_config['test_transform'].transforms[-1].mean, data_config['test_transform'].transforms[-1].std
+        x, y = buffer_to_tensors(buffer)
+        print_images(x[:1], y[:1], mean, std)
+        print_images(x[-1:], y[-1:], mean, std)
+
+    codec = MemoryCodec.from_config(config)
+    imgs, trgs = buffer_to_tensors(buffer)
+    stored = codec.encode(imgs)
+    if stored is not imgs:
+        log_metrics({f'Memory reconstruction RMSE {task_id}': (codec.decode(stored) - imgs).pow(2).mean().sqrt().item()}, config['log_config'])
+    return TensorBuffer(stored, trgs)
+
+
+class MemoryCodec:
+    """
+    Storage format of the memories (param_config['memory_dtype']): 'float32' keeps the normalized images as they
+    are, 'float16' and 'uint8' store them in pixel space, using the mean and std of the final Normalize of the test
+    transform as per-channel offset and scale ('uint8' clips to the [0, 1] pixel range).
+    """
+
+    def __init__(self, dtype, mean, std):
+        if dtype not in ('float32', 'float16', 'uint8'):
+            raise ValueError(f'Unknown memory dtype {dtype}')
+        self.dtype = dtype
+        self.mean = torch.as_tensor(np.asarray(mean), dtype=torch.float).view(-1, 1, 1)
+        self.std = torch.as_tensor(np.asarray(std), dtype=torch.float).view(-1, 1, 1)
+        self.levels = 255 if dtype == 'uint8' else 1
+
+    @classmethod
+    def from_config(cls, config):
+        normalize = config['data_config']['test_transform'].transforms[-1]
+        return cls(config['param_config']['memory_dtype'], normalize.mean, normalize.std)
+
+    def encode(self, imgs):
+        if self.dtype == 'float32':
+            return imgs
+        pixels = imgs * self.std.to(imgs.device) + self.mean.to(imgs.device)
+        if self.dtype == 'uint8':
+            return (pixels * self.levels).round().clamp(0, self.levels).to(torch.uint8)
+        return pixels.half()
+
+    def decode(self, stored):
+        """Normalized fp32 images of stored ones (no-op for fp32 storage)."""
+        if stored.dtype == torch.float32:
+            return stored
+        pixels = stored.float() / self.levels
+        return (pixels - self.mean.to(stored.device)) / self.std.to(stored.device)
+
+
+def distill_dm(model, buffer, config, criterion, train_loader, id):
     model = copy.deepcopy(model).to(config['run_config']['device'])
     run_config = config['run_config']
     param_config = config['param_config']
-    #log_config = config['log_config']
+    log_config = config['log_config']
     device = run_config['device']
 
     model.train()
 
-    buff_imgs, buff_trgs = next(iter(DataLoader(buffer, batch_size=len(buffer))))
+    buff_imgs, buff_trgs = buffer_to_tensors(buffer)
     buff_imgs, buff_trgs = buff_imgs.to(device), buff_trgs.to(device)
-    buff_imgs = buff_imgs.contiguous().requires_grad_(True)
+    buff_imgs = buff_imgs.clone().requires_grad_(True)  # Copy, the images of the buffer are not modified
 
     buff_opt = torch.optim.SGD([buff_imgs], lr=param_config['meta_lr'])
 
+    init_dataset = ModelInitDataset(model, param_config['n_inits'], load_init_bank(model, config, param_config['n_inits']), start=10)
     init_loader = DataLoader(
-        ModelInitDataset(model, param_config['n_inits']),
+        init_dataset,
         batch_size=1,
         collate_fn=lambda x: x
     )
+    # Stack the initializations so that all of them are evaluated in one vectorized pass
+    init_states = [init_state[0] for init_state in init_loader]
+    fmodel = functional_model(model)
+    params = init_dataset.stacked(fmodel, device)
+
+    # Distributed: each worker takes a shard of the initializations or of every real minibatch
+    rank, world = dist_info()
+    shard = param_config['distill_shard']
+    if shard == 'inits':
+        if len(init_states) < world:
+            raise ValueError('n_inits must be at least the number of workers')
+        params = {name: p[rank::world] for name, p in params.items()}
+
+    # Real data gradients are constant targets: with first order they are computed without graph,
+    # and with the cache the first epoch's real batches are kept fixed and their gradients reused
+    first_order = param_config['dm_first_order']
+    cache_real = param_config['dm_cache_real_grads']
+    if cache_real and not first_order:
+        raise ValueError('dm_cache_real_grads requires dm_first_order')
+    if not first_order:
+        params = {name: p.requires_grad_(True) for name, p in params.items()}
+
+    # Class-wise matching: the synthetic images of each class are matched against the real images of that class
+    classwise = param_config['dm_classwise']
+    classes = buff_trgs.unique()
+    syn_masks = (buff_trgs == classes.unsqueeze(1)).float()
+
+    real_cache = []
+    profile = None
+    computed = cached = 0
+
+    stopper = EarlyStopping(config, id)
+    checkpointer = Checkpointer(config)
+    state = checkpointer.load_distill(id, buff_imgs, buff_opt, stopper)
+    for i in range(0 if state is None else state['outer_step'] + 1, param_config['outer_steps']):
+        from_cache = cache_real and len(real_cache) > 0  # After resuming, the cache is rebuilt in the first outer step
+        for batch in (real_cache if from_cache else train_loader):
+            if from_cache:
+                real_grads, real_present, weight = batch
+                cached += 1
+            else:
+                real_data, real_labels = batch
+                real_data = real_data.to(device)
+                real_labels = real_labels.to(device)
+                if shard == 'batch':
+                    real_data, real_labels = real_data[rank::world], real_labels[rank::world]
+                # Weight of this worker's loss in the distributed average
+                weight = len(real_data) if shard == 'batch' else len(next(iter(params.values())))
+
+                if first_order and profile is None and weight > 0:
+                    profile = profile_real_grads(model, init_states[0], criterion, real_data, real_labels)
+
+                # Real data gradients for every initialization (and class)
+                real_grads = real_present = None
+                if weight > 0:
+                    with torch.set_grad_enabled(not first_order), autocast(device, run_config['precision']):
+                        if classwise:
+                            real_masks = (real_labels == classes.unsqueeze(1)).float()
+                            real_present = real_masks.sum(1) > 0
+                            real_grads = batched_class_grads(fmodel, params, real_data, real_labels, real_masks)
+                        else:
+                            real_grads = batched_grads(fmodel, params, criterion, real_data, real_labels)
+                if cache_real:
+                    real_cache.append((real_grads, real_present, weight))
+                computed += 1
+
+            buff_opt.zero_grad()
+            if weight == 0:
+                # The last short minibatch can leave this worker without real samples: it only joins the all-reduce
+                buff_imgs.grad = torch.zeros_like(buff_imgs)
+            else:
+                # Synthetic data gradients for every initialization (and class)
+                with autocast(device, run_config['precision']):
+                    if classwise:
+                        syn_grads = batched_class_grads(fmodel, params, buff_imgs, buff_trgs, syn_masks)
+                    else:
+                        syn_grads = batched_grads(fmodel, params, criterion, buff_imgs, buff_trgs)
+
+                # Calculate gradient matching loss (one value per initialization)
+                batch_dims = 2 if classwise else 1
+                total_grad_diff = sum(
+                    torch.linalg.vector_norm(real_grads[name] - syn_grads[name], dim=tuple(range(batch_dims, real_grads[name].dim())))
+                    for name in params
+                )
+                if classwise:
+                    # Only the classes present in the real minibatch are matched
+                    total_grad_diff = total_grad_diff[:, real_present].sum(1)
+
+                # Average and backpropagate
+                total_grad_diff = total_grad_diff.mean()
+                total_grad_diff.backward()
+                stopper.add(total_grad_diff)
+            all_reduce_grads([buff_imgs], weight)
+            buff_opt.step()
+
+        if stopper.stop(i):
+            break
+        checkpointer.save_distill(id, i, buff_imgs, buff_opt, stopper)
+
+    # Second-order memory and time saved w.r.t. keeping the real gradients' graph (estimated from the first batch)
+    if first_order and profile is not None:
+        (mem_2nd, time_2nd), (mem_1st, time_1st) = profile[True], profile[False]
+        n_inits = len(init_states)
+        log_metrics({f'DM real grads computed {id}': computed,
+                     f'DM real grads cached {id}': cached,
+                     f'DM second-order memory saved per step (MB) {id}': (mem_2nd - mem_1st) * n_inits / 2 ** 20,
+                     f'DM real grads time saved (s) {id}': ((time_2nd - time_1st) * computed + time_2nd * cached) * n_inits}, log_config)
+
+    # Convert buffer back to dataset
+    return TensorBuffer(buff_imgs.detach().cpu(), buff_trgs.detach().cpu()), []
+
+def distill_edm(model, buffer, config, train_loader, id):
+    model = copy.deepcopy(model).to(config['run_config']['device'])
+    run_config = config['run_config']
+    param_config = config['param_config']
+    device = run_config['device']
 
-    for i in range(param_config['outer_steps']):
+    model.train()
+
+    buff_imgs, buff_trgs = buffer_to_tensors(buffer)
+    buff_imgs, buff_trgs = buff_imgs.to(device), buff_trgs.to(device)
+    buff_imgs = buff_imgs.clone().requires_grad_(True)  # Copy, the images of the buffer are not modified
+
+    buff_opt = torch.optim.SGD([buff_imgs], lr=param_config['meta_lr'])
+
+    # Randomly initialized networks used as embedders (no gradients w.r.t. their parameters)
+    init_dataset = ModelInitDataset(model, param_config['n_inits'], load_init_bank(model, config, param_config['n_inits']), start=10)
+    fmodel = functional_model(model)
+    params = init_dataset.stacked(fmodel, device)
+
+    classes = buff_trgs.unique()
+    syn_onehot = (buff_trgs.unsqueeze(1) == classes).float()
+
+    stopper = EarlyStopping(config, id)
+    checkpointer = Checkpointer(config)
+    state = checkpointer.load_distill(id, buff_imgs, buff_opt, stopper)
+    for i in range(0 if state is None else state['outer_step'] + 1, param_config['outer_steps']):
         for (real_data, real_labels) in train_loader:
             real_data = real_data.to(device)
             real_labels = real_labels.to(device)
 
-            total_grad_diff = 0
-            
-            for init_state in init_loader:
-                # Create new model instance for each initialization
-                current_model = copy.deepcopy(model).to(device)
-                current_model.load_state_dict(init_state[0])
-                current_model.train()
-
-                # Real data gradients
-                real_output = current_model(real_data)
-                real_loss = criterion(real_output, real_labels)
-                real_grads = torch.autograd.grad(
-                    real_loss, 
-                    current_model.parameters(), 
-                    create_graph=True, 
-                    retain_graph=True
-                )
+            # Per-class mean embeddings of the real data under every embedder
+            real_onehot = (real_labels.unsqueeze(1) == classes).float()
+            real_counts = real_onehot.sum(0)
+            with torch.no_grad(), autocast(device, run_config['precision']):
+                real_emb = batched_embed(fmodel, params, real_data).float()
+                real_mean = torch.einsum('nbd,bc->ncd', real_emb, real_onehot) / real_counts.clamp(min=1).unsqueeze(1)
 
-                # Synthetic data gradients
-                syn_output = current_model(buff_imgs)
-                syn_loss = criterion(syn_output, buff_trgs)
-                syn_grads = torch.autograd.grad(
-                    syn_loss, 
-                    current_model.parameters(), 
-                    create_graph=True, 
-                    retain_graph=True
-                )
+            # Per-class mean embeddings of the synthetic data
+            with autocast(device, run_config['precision']):
+                syn_emb = batched_embed(fmodel, params, buff_imgs).float()
+            syn_mean = torch.einsum('nbd,bc->ncd', syn_emb, syn_onehot) / syn_onehot.sum(0).unsqueeze(1)
+
+            # Match the means of the classes present in the real minibatch, averaged over embedders
+            dist_loss = ((real_mean - syn_mean) ** 2).sum(-1)[:, real_counts > 0].sum(-1).mean()
+            buff_opt.zero_grad()
+            dist_loss.backward()
+            buff_opt.step()
+            stopper.add(dist_loss)
+
+        if stopper.stop(i):
+            break
+        checkpointer.save_distill(id, i, buff_imgs, buff_opt, stopper)
+
+    # Convert buffer back to dataset
+    return TensorBuffer(buff_imgs.detach().cpu(), buff_trgs.detach().cpu()), []
+
+def distill_krr(model, buffer, config, train_loader, id):
+    model = copy.deepcopy(model).to(config['run_config']['device'])
+    run_config = config['run_config']
+    param_config = config['param_config']
+    device = run_config['device']
+
+    model.train()
+
+    buff_imgs, buff_trgs = buffer_to_tensors(buffer)
+    buff_imgs, buff_trgs = buff_imgs.to(device), buff_trgs.to(device)
+    buff_imgs = buff_imgs.clone().requires_grad_(True)  # Copy, the images of the buffer are not modified
+
+    buff_opt = torch.optim.SGD([buff_imgs], lr=param_config['meta_lr'])
+
+    # Randomly initialized networks defining the kernels (one kernel ridge regression per initialization)
+    init_dataset = ModelInitDataset(model, param_config['n_inits'], load_init_bank(model, config, param_config['n_inits']), start=10)
+    fmodel = functional_model(model)
+    params = init_dataset.stacked(fmodel, device)
+
+    if param_config['krr_kernel'] == 'rf':
+        features = batched_embed
+    elif param_config['krr_kernel'] == 'ntk':
+        features = batched_ntk_features
+    else:
+        raise ValueError
+
+    classes = buff_trgs.unique()
+    syn_onehot = (buff_trgs.unsqueeze(1) == classes).float()
+    eye = torch.eye(buff_imgs.size(0), device=device)
+
+    stopper = EarlyStopping(config, id)
+    checkpointer = Checkpointer(config)
+    state = checkpointer.load_distill(id, buff_imgs, buff_opt, stopper)
+    for i in range(0 if state is None else state['outer_step'] + 1, param_config['outer_steps']):
+        for (real_data, real_labels) in train_loader:
+            real_data = real_data.to(device)
+            real_labels = real_labels.to(device)
+            real_onehot = (real_labels.unsqueeze(1) == classes).float()
 
-                # Calculate gradient matching loss
-                layer_losses = [
-                    torch.norm(rg - sg, p=2) 
-                    for rg, sg in zip(real_grads, syn_grads)
-                ]
-                total_grad_diff += sum(layer_losses)
+            # Features under autocast, solve in fp32
+            with autocast(device, run_config['precision']):
+                with torch.no_grad():
+                    real_f = features(fmodel, params, real_data).float()
+                syn_f = features(fmodel, params, buff_imgs).float()
 
-            # Average and backpropagate
-            total_grad_diff /= len(init_loader)
+            # Support (buffer) - target (real minibatch) solve, batched over the initializations
+            k_ss = syn_f @ syn_f.transpose(1, 2)
+            k_ts = real_f @ syn_f.transpose(1, 2)
+            ridge = param_config['krr_ridge'] * k_ss.diagonal(dim1=1, dim2=2).mean(1)
+            alpha = torch.linalg.solve(k_ss + ridge[:, None, None] * eye, syn_onehot.expand(k_ss.size(0), -1, -1))
+
+            krr_loss = ((k_ts @ alpha - real_onehot) ** 2).sum(-1).mean()
             buff_opt.zero_grad()
-            total_grad_diff.backward()
+            krr_loss.backward()
             buff_opt.step()
+            stopper.add(krr_loss)
+
+        if stopper.stop(i):
+            break
+        checkpointer.save_distill(id, i, buff_imgs, buff_opt, stopper)
 
     # Convert buffer back to dataset
-    aux = []
-    buff_imgs, buff_trgs = buff_imgs.detach().cpu(), buff_trgs.detach().cpu()
-    for i in range(buff_imgs.size(0)):
-        aux.append([buff_imgs[i], buff_trgs[i]])
-    return Buffer(aux, len(aux)), []
+    return TensorBuffer(buff_imgs.detach().cpu(), buff_trgs.detach().cpu()), []
 
 def distill(model, buffer, config, criterion, train_loader, valid_loader, id):
     model = copy.deepcopy(model).to(config['run_config']['device'])
@@ -325,18 +1046,27 @@ def distill(model, buffer, config, criterion, train_loader, valid_loader, id):
     log_config = config['log_config']
 
     model.train()
-    eval_trainloader = copy.deepcopy(train_loader)
 
-    buff_imgs, buff_trgs = next(iter(DataLoader(buffer, batch_size=len(buffer))))
+    # Evaluation schedule (optionally on fixed stratified subsets of the train and valid data)
+    eval_steps = distill_eval_schedule(len(train_loader) * param_config['outer_steps'], param_config['distill_eval_points'])
+    if eval_steps and param_config['distill_eval_samples'] is not None:
+        eval_trainloader = eval_subset(train_loader, param_config['distill_eval_samples'], param_config['distill_batch_size'], run_config['device'])
+        valid_loader = eval_subset(valid_loader, param_config['distill_eval_samples'], param_config['distill_batch_size'], run_config['device'])
+    else:
+        eval_trainloader = train_loader
+
+    buff_imgs, buff_trgs = buffer_to_tensors(buffer)
     #buff_imgs, buff_trgs = buff_imgs.to(run_config['device']), buff_trgs.to(run_config['device'])
     buff_imgs = buff_imgs.to(device)
     buff_trgs = buff_trgs.to(device)
 
     #buff_imgs.requires_grad = True
-    buff_imgs = buff_imgs.contiguous().requires_grad_(True)
+    buff_imgs = buff_imgs.clone().requires_grad_(True)  # Copy, the images of the buffer are not modified
 
-    init_valid = DataLoader(ModelInitDataset(model, 10), batch_size=1, collate_fn=lambda x: x)
-    init_loader = DataLoader(ModelInitDataset(model, -1), batch_size=1, collate_fn=lambda x: x)
+    # With an initialization bank, the first 10 inits are kept for validation
+    init_bank = load_init_bank(model, config, param_config['distill_inits'])
+    init_valid = DataLoader(ModelInitDataset(model, 10, init_bank), batch_size=1, collate_fn=lambda x: x)
+    init_loader = DataLoader(ModelInitDataset(model, -1, init_bank, start=10), batch_size=param_config['distill_inits'], collate_fn=lambda x: x)
     init_iter = iter(init_loader)
 
     buff_opt = torch.optim.SGD([buff_imgs], lr=param_config['meta_lr'],)
@@ -349,103 +1079,481 @@ def distill(model, buffer, config, criterion, train_loader, valid_loader, id):
         lr_list.append(lr)
         lr_opts.append(torch.optim.SGD([lr], param_config['lr_lr'],))
 
-    for i in range(param_config['outer_steps']):
+    # Memory-bounded unroll: checkpointed segments of inner steps and/or backprop through the last inner steps only
+    segment = param_config['distill_checkpoint_segment']
+    truncate = param_config['distill_truncate']
+    first = 0 if truncate is None else max(param_config['inner_steps'] - truncate, 0)  # First differentiated inner step
+    segment_bytes = None
+    fmodel = functional_model(model)
+
+    # Distributed: each worker takes a shard of every real minibatch or its own initializations
+    rank, world = dist_info()
+    shard = param_config['distill_shard']
+
+    stopper = EarlyStopping(config, id)
+    checkpointer = Checkpointer(config)
+    state = checkpointer.load_distill(id, buff_imgs, buff_opt, stopper)
+    if state is not None:
+        for lr, saved_lr, lr_opt, lr_opt_state in zip(lr_list, state['lr_list'], lr_opts, state['lr_opts']):
+            lr.data.copy_(saved_lr)
+            lr_opt.load_state_dict(lr_opt_state)
+        init_valid.dataset.inits = state['init_valid']
+
+    # Every worker generates the validation inits and the evaluations (on the first worker only) do not use the
+    # global RNG, so that all the workers keep drawing the same inits and permutations of the real data
+    list(init_valid)
+    for i in range(0 if state is None else state['outer_step'] + 1, param_config['outer_steps']):
+        start_time = time.time()
+        graph_bytes = 0
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
         for step, (ds_imgs, ds_trgs) in enumerate(train_loader):
-            try: init_batch = next(init_iter)
-            except StopIteration: init_iter = iter(init_loader); init_batch = next(init_iter)
+            init_batches = []
+            for _ in range(world if shard == 'inits' else 1):
+                try: init_batch = next(init_iter)
+                except StopIteration: init_iter = iter(init_loader); init_batch = next(init_iter)
+                init_batches.append(init_batch)
+            init_batch = init_batches[rank if shard == 'inits' else 0]
 
             ds_imgs = ds_imgs.to(run_config['device'])
             ds_trgs = ds_trgs.to(run_config['device'])
+            if shard == 'batch':
+                ds_imgs, ds_trgs = ds_imgs[rank::world], ds_trgs[rank::world]
+            # Weight of this worker's loss in the distributed average
+            weight = len(ds_imgs) if shard == 'batch' else 1
+
+            if weight == 0:
+                # The last short minibatch can leave this worker without real samples: it only joins the all-reduce
+                buff_imgs.grad = torch.zeros_like(buff_imgs)
+                for lr in lr_list[first:]:
+                    lr.grad = torch.zeros_like(lr)
+                all_reduce_grads([buff_imgs] + lr_list[first:], weight)
+                for lr_opt in lr_opts[first:]:
+                    lr_opt.step()
+                buff_opt.step()
+                continue
 
             acc_loss = None
             epoch_loss = [None for _ in range(param_config['inner_steps'])]
 
-            for r, sigma in enumerate(init_batch):
-                model.load_state_dict(sigma)
-                model_opt = torch.optim.SGD(model.parameters(), lr=1, )
-                with higher.innerloop_ctx(model, model_opt) as (fmodel, diffopt):
-                    for j in range(param_config['inner_steps']):
-                        # Update the model
-                        buff_out = fmodel(buff_imgs)
-                        buff_loss = criterion(buff_out, buff_trgs)
-                        buff_loss = buff_loss * torch.log(1 + torch.exp(lr_list[j]))
-                        diffopt.step(buff_loss)
-
-                        ds_out = fmodel(ds_imgs)
-                        ds_loss = criterion(ds_out, ds_trgs)
-
-                        epoch_loss[j] = epoch_loss[j] + ds_loss if epoch_loss[j] is not None else ds_loss
-                        acc_loss = acc_loss + ds_loss if acc_loss is not None else ds_loss
-
-                        # Metrics (20 samples of loss and accuracy at the last inner step)
-                        if (((step + i * len(train_loader)) % int(round(len(train_loader) * param_config['outer_steps'] * 0.05)) == \
-                                int(round(len(train_loader) * param_config['outer_steps'] * 0.05)) - 1) or (step + i * len(train_loader)) == 0) \
-                                and j == param_config['inner_steps'] - 1 and r == 0:
-
-                            lrs = [np.log(np.exp(lr.item()) + 1) for lr in lr_list]
-                            lrs_log = {f'Learning rate {i} - {id}': lr for (i, lr) in enumerate(lrs)}
-                            train_loss, train_accuracy = test_distill(init_valid, lrs, [buff_imgs, buff_trgs], model, criterion, eval_trainloader, run_config)
-                            test_loss, test_accuracy = test_distill(init_valid, lrs, [buff_imgs, buff_trgs], model, criterion, valid_loader, run_config)
-                            metrics = {f'Distill train loss {id}': train_loss, f'Distill train accuracy {id}': train_accuracy,
-                                       f'Distill test loss {id}': test_loss, f'Distill test accuracy {id}': test_accuracy,
-                                       f'Distill step {id}': step + i * len(train_loader)}
-
-                            if log_config['wandb']:
-                                wandb.log({**metrics, **lrs_log})
-
-                            if log_config['print']:
-                                print(metrics)
-
-            # Update the lrs
+            params = stack_inits(fmodel, init_batch, run_config['device'])
+
+            # With checkpointing, the backward also holds the graph of one recomputed segment, which the saved
+            # tensors of the forward do not include: it is measured once, unrolling one segment without checkpoint
+            if segment > 0 and segment_bytes is None:
+                length = min(segment, len(lr_list) if truncate is None else min(truncate, len(lr_list)))
+                with SavedTensorsMeter() as segment_meter, autocast(run_config['device'], run_config['precision']):
+                    unroll(fmodel, params, [buff_imgs, buff_trgs], [ds_imgs, ds_trgs], lr_list[:length], criterion, 0, None)
+                segment_bytes = segment_meter.bytes
+
+            # Unroll all the initializations of the batch together
+            with SavedTensorsMeter() as meter, autocast(run_config['device'], run_config['precision']):
+                ds_losses = unroll(fmodel, params, [buff_imgs, buff_trgs], [ds_imgs, ds_trgs], lr_list, criterion, segment, truncate)
+                for j, ds_loss in ds_losses.items():
+                    epoch_loss[j] = ds_loss
+                    acc_loss = acc_loss + ds_loss if acc_loss is not None else ds_loss
+            graph_bytes = max(graph_bytes, meter.bytes + (segment_bytes or 0))
+
+            # Metrics ('distill_eval_points' samples of loss and accuracy at the last inner step)
+            if rank == 0 and step + i * len(train_loader) in eval_steps:
+
+                lrs = [np.log(np.exp(lr.item()) + 1) for lr in lr_list]
+                lrs_log = {f'Learning rate {i} - {id}': lr for (i, lr) in enumerate(lrs)}
+                with torch.random.fork_rng():
+                    train_loss, train_accuracy = test_distill(init_valid, lrs, [buff_imgs, buff_trgs], model, criterion, eval_trainloader, run_config)
+                    test_loss, test_accuracy = test_distill(init_valid, lrs, [buff_imgs, buff_trgs], model, criterion, valid_loader, run_config)
+                metrics = {f'Distill train loss {id}': train_loss, f'Distill train accuracy {id}': train_accuracy,
+                           f'Distill test loss {id}': test_loss, f'Distill test accuracy {id}': test_accuracy,
+                           f'Distill step {id}': step + i * len(train_loader)}
+
+                if log_config['wandb']:
+                    wandb.log({**metrics, **lrs_log})
+
+                if log_config['print']:
+                    print(metrics)
+
+            # Gradients of the lrs (the truncated inner steps have no graph) and of the buffer
+            lr_grads = {}
             for j in range(param_config['inner_steps']):
-                lr_opts[j].zero_grad()
-                grad, = autograd.grad(epoch_loss[j], lr_list[j], retain_graph=True)
-                lr_list[j].grad = grad
-                lr_opts[j].step()
+                if epoch_loss[j] is None:
+                    continue
+                lr_grads[j], = autograd.grad(epoch_loss[j], lr_list[j], retain_graph=True)
 
             buff_opt.zero_grad()
             acc_loss.backward()
+            for j, lr_grad in lr_grads.items():
+                lr_list[j].grad = lr_grad
+            all_reduce_grads([buff_imgs] + [lr_list[j] for j in lr_grads], weight)
+
+            for j in lr_grads:
+                lr_opts[j].step()
             buff_opt.step()
+            stopper.add(acc_loss)
+
+        # Peak memory of the unrolled graph and time of the outer step
+        memory_m = {f'Distill outer step {id}': i,
+                    f'Distill outer step time {id}': time.time() - start_time,
+                    f'Distill graph memory (MB) {id}': graph_bytes / 2 ** 20}
+        if torch.cuda.is_available():
+            memory_m[f'Distill peak CUDA memory (MB) {id}'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        log_metrics(memory_m, log_config)
+
+        if stopper.stop(i):
+            break
+        checkpointer.save_distill(id, i, buff_imgs, buff_opt, stopper, lr_list=[lr.detach().cpu() for lr in lr_list],
+                                  lr_opts=[lr_opt.state_dict() for lr_opt in lr_opts], init_valid=init_valid.dataset.inits)
 
-    aux = []
-    buff_imgs, buff_trgs = buff_imgs.detach().cpu(), buff_trgs.detach().cpu()
-    for i in range(buff_imgs.size(0)):
-        aux.append([buff_imgs[i], buff_trgs[i]])
     lr_list = [np.log(1 + np.exp(lr.item())) for lr in lr_list]
 
-    return Buffer(aux, len(aux), ), lr_list
+    return TensorBuffer(buff_imgs.detach().cpu(), buff_trgs.detach().cpu()), lr_list
+
+
+def dist_info():
+    """Rank and number of workers of the distributed distillation ((0, 1) when it is not distributed)."""
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+def all_reduce_grads(tensors, weight=1):
+    """
+    Averages the gradients of tensors over the distributed workers (in one all-reduce), weighting those of each
+    worker by the number of initializations or samples its loss averaged over.
+    """
+    world = dist_info()[1]
+    if world == 1:
+        return
+    grads = [t.grad for t in tensors]
+    flat = torch.cat([g.flatten() * weight for g in grads] + [grads[0].new_tensor([weight])])
+    torch.distributed.all_reduce(flat)
+    flat = flat[:-1] / flat[-1]
+    for g, reduced in zip(grads, flat.split([g.numel() for g in grads])):
+        g.copy_(reduced.view_as(g))
+
+
+class EarlyStopping:
+    """
+    Early stopping of a distillation outer loop: it stops when the mean objective of the outer steps, smoothed
+    over the last 'distill_smoothing' of them, has not improved by 'distill_min_delta' for 'distill_patience' outer steps.
+    """
+
+    def __init__(self, config, id):
+        param_config = config['param_config']
+        self.patience = param_config['distill_patience']
+        if self.patience is not None and self.patience < 1:
+            raise ValueError('distill_patience must be at least 1 (None: no early stopping)')
+        self.min_delta = param_config['distill_min_delta']
+        self.window = param_config['distill_smoothing']
+        self.outer_steps = param_config['outer_steps']
+        self.log_config = config['log_config']
+        self.id = id
+
+        self.objective = 0
+        self.n = 0
+        self.history = []
+        self.best = float('inf')
+        self.bad_steps = 0
+        self.start_time = time.time()
+        self.steps_run = 0  # Outer steps run by this process (after a resume, the earlier ones are not timed)
+
+    def state_dict(self):
+        return {'history': self.history, 'best': self.best, 'bad_steps': self.bad_steps}
+
+    def load_state_dict(self, state):
+        self.history, self.best, self.bad_steps = state['history'], state['best'], state['bad_steps']
+
+    def add(self, objective):
+        """Accumulates the objective of a minibatch (on the device)."""
+        if self.patience is not None:
+            self.objective = self.objective + objective.detach().float()
+            self.n += 1
+
+    def stop(self, step):
+        """Ends outer step 'step' (one host sync); True if the outer loop should stop."""
+        if self.patience is None:
+            return False
+        self.steps_run += 1
+
+        # In distributed mode the workers average their objectives, so that they all stop together
+        # (a worker may have no minibatches, when its shards were all empty)
+        totals = torch.stack([torch.as_tensor(self.objective).float().cpu(), torch.tensor(float(self.n))])
+        if dist_info()[1] > 1:
+            torch.distributed.all_reduce(totals)
+        self.objective = 0
+        self.n = 0
+        if totals[1] == 0:
+            return False
+        self.history.append((totals[0] / totals[1]).item())
+
+        smoothed = np.mean(self.history[-self.window:])
+        if smoothed < self.best - self.min_delta:
+            self.best = smoothed
+            self.bad_steps = 0
+        else:
+            self.bad_steps += 1
+
+        if self.bad_steps < self.patience or step == self.outer_steps - 1:
+            return False
+
+        # Time saved estimated from the mean time of the outer steps run so far by this process
+        step_time = (time.time() - self.start_time) / self.steps_run
+        log_metrics({f'Distill early stop step {self.id}': step,
+                     f'Distill early stop time saved (s) {self.id}': step_time * (self.outer_steps - step - 1)}, self.log_config)
+        return True
+
+
+def distill_eval_schedule(total_steps, points):
+    """Distillation steps at which the buffer is evaluated: the first one and then every total_steps / points."""
+    if points <= 0:
+        return set()
+    every = max(int(round(total_steps / points)), 1)
+    return {0} | set(range(every - 1, total_steps, every))
+
+
+def eval_subset(loader, per_class, batch_size, device):
+    """Fixed stratified subset (per_class samples of each class) of the data of loader, cached as tensors."""
+    data, targets = zip(*[(x.to(device), y.to(device)) for x, y in loader])
+    data, targets = torch.cat(data), torch.cat(targets)
+
+    idx = torch.cat([(targets == c).nonzero().flatten()[:per_class] for c in targets.unique()])
+    return TensorLoader(TensorSplit(data[idx], targets[idx]), batch_size, False, device)
 
 
 def test_distill(init_valid, lrs, buffer, model, criterion, eval_trainloader, run_config):
     buff_imgs, buff_trgs = buffer
+    buff_imgs = buff_imgs.detach()
+
+    # All the validation initializations are trained and evaluated together
+    fmodel = functional_model(model)
+    params = stack_inits(fmodel, [init for init_batch in init_valid for init in init_batch], run_config['device'])
+
+    fmodel.train()
+    for lr in lrs:
+        with torch.enable_grad(), autocast(run_config['device'], run_config['precision']):
+            params = {name: p.requires_grad_(True) for name, p in params.items()}
+            loss = batched_losses(fmodel, params, criterion, buff_imgs, buff_trgs).sum()
+            grads = autograd.grad(loss, list(params.values()), allow_unused=True)
+        params = {name: (p if g is None else p - lr * g).detach() for (name, p), g in zip(params.items(), grads)}
+
+    fmodel.eval()
+    n_inits = next(iter(params.values())).size(0)
+    loss_sum = torch.zeros(n_inits, device=run_config['device'])
+    correct = torch.zeros(n_inits, device=run_config['device'])
+    tot = 0
 
-    avg_loss = avg_accuracy = 0
-
-    for init_batch in init_valid:
-        for init in init_batch:
-            model.load_state_dict(init)
+    with torch.no_grad(), autocast(run_config['device'], run_config['precision']):
+        for data, targets in eval_trainloader:
+            data = data.to(run_config['device'])
+            targets = targets.to(run_config['device'])
 
-            for lr in lrs:
-                opt = torch.optim.SGD(model.parameters(), lr=lr, )
-                pred = model(buff_imgs)
-                loss = criterion(pred, buff_trgs)
+            outputs = vmap(functional_call, in_dims=(None, 0, None))(fmodel, params, (data,))
+            loss = vmap(criterion, in_dims=(0, None))(outputs, targets)
+            _, preds = torch.max(outputs, dim=2)
 
-                opt.zero_grad()
-                loss.backward()
-                opt.step()
+            loss_sum += loss * data.size(0)
+            correct += preds.eq(targets).sum(1)
+            tot += data.size(0)
 
-            test_loss, test_accuracy = test(model, criterion, eval_trainloader, run_config)
-            avg_loss += (test_loss / len(init_valid))
-            avg_accuracy += (test_accuracy / len(init_valid))
+    avg_loss, avg_accuracy = torch.stack(((loss_sum / tot).mean(), (correct / tot).mean())).tolist()
 
     return avg_loss, avg_accuracy
 
 
+def autocast(device, precision):
+    """Autocast context of the given precision: 'bf16' runs the forward passes in bfloat16 (parameters,
+    buffer images, learning rates and optimizer states stay in fp32), 'fp32' disables it."""
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError(f'Unknown precision {precision}')
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def functional_model(model):
+    """Stateless copy of model to be used with torch.func (batch norm always uses batch statistics)."""
+    fmodel = copy.deepcopy(model)
+    torch.func.replace_all_batch_norm_modules_(fmodel)
+    return fmodel
+
+
+def stack_inits(fmodel, inits, device):
+    """Stacks the parameters of a list of state_dicts into {name: [len(inits), *shape]} tensors."""
+    return {name: torch.stack([init[name] for init in inits]).to(device) for name, _ in fmodel.named_parameters()}
+
+
+def batched_grads(fmodel, params, criterion, data, targets):
+    """Gradients of the loss on (data, targets) w.r.t. every stacked set of parameters."""
+    def loss_fn(p, x, y):
+        return criterion(functional_call(fmodel, p, (x,)), y)
+
+    return vmap(grad(loss_fn), in_dims=(0, None, None), randomness='different')(params, data, targets)
+
+
+def batched_losses(fmodel, params, criterion, data, targets):
+    """Loss on (data, targets) of every stacked set of parameters (only the forward is vectorized, so it can be differentiated with autograd)."""
+    def loss_fn(p, x, y):
+        return criterion(functional_call(fmodel, p, (x,)), y)
+
+    return vmap(loss_fn, in_dims=(0, None, None), randomness='different')(params, data, targets)
+
+
+def batched_class_grads(fmodel, params, data, targets, masks):
+    """Per-class gradients for every stacked set of parameters: masks ([n_classes, batch]) selects the samples of each class."""
+    def loss_fn(p, x, y, mask):
+        loss = nn.functional.cross_entropy(functional_call(fmodel, p, (x,)), y, reduction='none')
+        return (loss * mask).sum() / mask.sum().clamp(min=1)
+
+    class_grads = vmap(grad(loss_fn), in_dims=(None, None, None, 0), randomness='same')
+    return vmap(class_grads, in_dims=(0, None, None, None), randomness='different')(params, data, targets, masks)
+
+
+def batched_embed(fmodel, params, data):
+    """Embeddings of data (input of the last linear layer) for every stacked set of parameters."""
+    classifier = [module for module in fmodel.modules() if isinstance(module, nn.Linear)][-1]
+
+    def embed_fn(p, x):
+        emb = []
+        handle = classifier.register_forward_pre_hook(lambda module, inputs: emb.append(inputs[0]))
+        try:
+            functional_call(fmodel, p, (x,))
+        finally:
+            handle.remove()
+        return emb[0]
+
+    return vmap(embed_fn, in_dims=(0, None), randomness='different')(params, data)
+
+
+def unroll(fmodel, params, buffer, batch, lr_list, criterion, segment, truncate):
+    """
+    Differentiable inner loop of distill, vectorized over the stacked initializations in params: SGD steps
+    on the buffer, returning {inner step: loss on the real minibatch summed over the initializations}.
+    Only the last 'truncate' steps are differentiated (all of them if None), and the trajectory is
+    checkpointed every 'segment' steps (no checkpointing if 0).
+    """
+    buff_imgs, buff_trgs = buffer
+    ds_imgs, ds_trgs = batch
+    names = list(params)
+
+    # A single initialization (e.g. distill_inits=1) is unrolled without vmap, which would have nothing to batch
+    single = params[names[0]].size(0) == 1
+    params = [params[name].detach()[0] if single else params[name].detach() for name in names]
+
+    def summed_loss(params, data, targets):
+        if single:
+            return criterion(functional_call(fmodel, dict(zip(names, params)), (data,)), targets)
+        return batched_losses(fmodel, dict(zip(names, params)), criterion, data, targets).sum()
+
+    # The initializations are independent, so the gradient of the summed losses holds the gradient of each one
+    # (parameters not used by the forward, e.g. fc2 of cnn2, have no gradient and are left as they are)
+    def sgd_step(params, buff_imgs, lr, create_graph):
+        buff_loss = summed_loss(params, buff_imgs, buff_trgs)
+        buff_loss = buff_loss * torch.log(1 + torch.exp(lr))
+        grads = autograd.grad(buff_loss, params, create_graph=create_graph, allow_unused=True)
+        return [p if g is None else p - g for p, g in zip(params, grads)]
+
+    # Truncated steps: plain SGD, without graph
+    first = 0 if truncate is None else max(len(lr_list) - truncate, 0)
+    for j in range(first):
+        params = [p.detach() for p in sgd_step([p.requires_grad_(True) for p in params], buff_imgs.detach(), lr_list[j].detach(), False)]
+
+    # The losses are separate outputs: stacking them would make the gradient of each one (w.r.t. its lr)
+    # go through all the later inner steps too
+    def segment_fn(buff_imgs, *tensors):
+        params, lrs = list(tensors[:len(names)]), tensors[len(names):]
+        ds_losses = []
+        for lr in lrs:
+            params = sgd_step(params, buff_imgs, lr, True)
+            ds_losses.append(summed_loss(params, ds_imgs, ds_trgs))
+        return (*params, *ds_losses)
+
+    params = [p.requires_grad_(True) for p in params]
+    length = segment if segment > 0 else len(lr_list)
+    ds_losses = {}
+    for start in range(first, len(lr_list), length):
+        end = min(start + length, len(lr_list))
+        args = (buff_imgs, *params, *lr_list[start:end])
+        out = checkpoint(segment_fn, *args, use_reentrant=False) if segment > 0 else segment_fn(*args)
+        params = list(out[:len(names)])
+        ds_losses.update(zip(range(start, end), out[len(names):]))
+
+    return ds_losses
+
+
+class SavedTensorsMeter:
+    """
+    Peak bytes of the tensors saved for backward (i.e. the size of the autograd graph) by the operations run while
+    it is active. Saved tensors are counted until the graph releases them, so it is the peak of the live ones.
+    Tensors saved inside checkpointed functions (and recomputed in backward) are not seen.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.live = 0
+
+    def __enter__(self):
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda saved: saved.t)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+
+    def _pack(self, t):
+        return _SavedTensor(self, t)
+
+
+class _SavedTensor:
+    """Tensor saved for backward, accounted to a SavedTensorsMeter until the graph releases it."""
+
+    def __init__(self, meter, t):
+        self.meter = meter
+        self.t = t
+        self.size = t.numel() * t.element_size()
+        meter.live += self.size
+        meter.bytes = max(meter.bytes, meter.live)
+
+    def __del__(self):
+        self.meter.live -= self.size
+
+
+def batched_ntk_features(fmodel, params, data):
+    """Per-sample gradients of the summed logits (empirical NTK features) for every stacked set of parameters."""
+    def output_fn(p, x):
+        return functional_call(fmodel, p, (x.unsqueeze(0),)).sum()
+
+    per_sample = vmap(grad(output_fn), in_dims=(None, 0), randomness='different')
+    grads = vmap(per_sample, in_dims=(0, None), randomness='different')(params, data)
+    return torch.cat([g.flatten(2) for g in grads.values()], dim=2)
+
+
+def profile_real_grads(model, init, criterion, data, targets):
+    """Bytes saved for backward and time of the real data gradients of one initialization,
+    with (True) and without (False) the double-backward graph."""
+    model = copy.deepcopy(model)
+    model.load_state_dict(init)
+    model.train()
+    with torch.no_grad():
+        model(data)  # Warm-up, so that it is not accounted to the first measure
+
+    profile = {}
+    for create_graph in (True, False):
+        start_time = time.time()
+        with SavedTensorsMeter() as meter:
+            loss = criterion(model(data), targets)
+            torch.autograd.grad(loss, model.parameters(), create_graph=create_graph, allow_unused=True)
+        if data.is_cuda:
+            torch.cuda.synchronize()
+        profile[create_graph] = (meter.bytes, time.time() - start_time)
+
+    return profile
+
+
 class ModelInitDataset(IterableDataset):
 
-    def __init__(self, target, len):
+    def __init__(self, target, len, bank=None, start=0):
         self.target = copy.deepcopy(target)
         self.len = len
+        self.bank = bank
+        self.start = start
         self.inits = []
         self.i = 0
 
@@ -457,7 +1565,9 @@ class ModelInitDataset(IterableDataset):
         if self.i >= self.len and self.len >= 0:
             raise StopIteration
 
-        if len(self.inits) - 1 >= self.i:
+        if self.bank is not None:
+            res = self.bank[self.start + self.i % (len(self.bank) - self.start)]
+        elif len(self.inits) - 1 >= self.i:
             res = self.inits[self.i]
         else:
             res = copy.deepcopy(self.target.apply(initialize_weights).state_dict())
@@ -469,3 +1579,277 @@ class ModelInitDataset(IterableDataset):
 
     def __len__(self):
         return self.len
+
+    def stacked(self, fmodel, device):
+        """Parameters of all the initializations as {name: [len, *shape]} (views of the bank when possible)."""
+        if self.bank is not None and 0 <= self.len <= len(self.bank) - self.start:
+            return self.bank.stacked(self.start, self.len, [name for name, _ in fmodel.named_parameters()], device)
+        return stack_inits(fmodel, list(self), device)
+
+
+class InitBank:
+    """
+    Initializations of an architecture generated once (per seed) and stored as the rows of a
+    flat [n, n_weights] memory-mapped .npy file, so that tasks, runs and workers can share them.
+    """
+
+    def __init__(self, target, n, path, seed, dtype='float32'):
+        template = target.state_dict()
+        self.template = template
+        self.names = [name for name, t in template.items() if t.is_floating_point()]
+        self.shapes = [template[name].shape for name in self.names]
+        self.offsets = np.cumsum([0] + [template[name].numel() for name in self.names]).tolist()
+
+        signature = hashlib.sha1(repr([(name, tuple(shape)) for name, shape in zip(self.names, self.shapes)]).encode()).hexdigest()[:10]
+        self.file = os.path.join(path, f'{type(target).__module__}_{signature}_s{seed}_n{n}_{dtype}.npy')
+
+        if not os.path.exists(self.file):
+            os.makedirs(path, exist_ok=True)
+            tmp = f'{self.file}.{os.getpid()}.tmp'
+            bank = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.dtype(dtype), shape=(n, self.offsets[-1]))
+            target = copy.deepcopy(target).cpu()
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed)
+                for k in range(n):
+                    state = target.apply(initialize_weights).state_dict()
+                    bank[k] = torch.cat([state[name].flatten() for name in self.names]).numpy()
+            bank.flush()
+            del bank
+            os.replace(tmp, self.file)  # Atomic, in case other processes are building the same bank
+
+        self.flat = torch.from_numpy(np.load(self.file, mmap_mode='c'))
+
+    def __len__(self):
+        return self.flat.size(0)
+
+    def __getitem__(self, k):
+        state = OrderedDict(self.template)
+        for name, shape, start, end in zip(self.names, self.shapes, self.offsets, self.offsets[1:]):
+            state[name] = self.flat[k, start:end].view(shape).float()
+        return state
+
+    def stacked(self, start, n, names, device):
+        rows = self.flat[start:start + n]
+        return {name: rows[:, begin:end].view(n, *shape).to(device, torch.float32)
+                for name, shape, begin, end in zip(self.names, self.shapes, self.offsets, self.offsets[1:])
+                if name in names}
+
+
+_init_banks = {}
+def load_init_bank(model, config, n_inits):
+    """
+    Initialization bank of model for the current run (None if it is disabled in the config). Besides the 10
+    validation initializations, it must hold the n_inits used together by the distillation.
+    """
+    run_config = config['run_config']
+    param_config = config['param_config']
+
+    if run_config['init_bank'] is None:
+        return None
+
+    if param_config['init_bank_size'] < 10 + n_inits:
+        raise ValueError(f"init_bank_size must be at least {10 + n_inits}: 10 validation initializations "
+                         f"and {n_inits} for the distillation, got {param_config['init_bank_size']}")
+
+    key = (type(model).__module__, run_config['init_bank'], run_config['seed'])
+    if key not in _init_banks:
+        _init_banks[key] = InitBank(model, param_config['init_bank_size'], run_config['init_bank'],
+                                    run_config['seed'], param_config['init_bank_dtype'])
+    return _init_banks[key]
+
+
+class TensorSplit:
+    """
+    Task split kept as one contiguous tensor of (already transformed) samples and one of targets.
+    The transform is applied only once, so it must be deterministic.
+    """
+
+    def __init__(self, data, targets):
+        self.data = data
+        self.targets = targets
+
+    @classmethod
+    def from_dataset(cls, ds, num_workers=0):
+        data, targets = [], []
+        for x, y in DataLoader(ds, batch_size=1024, shuffle=False, num_workers=num_workers):
+            data.append(x)
+            targets.append(y)
+        return cls(torch.cat(data).contiguous(), torch.cat(targets).contiguous())
+
+    @classmethod
+    def load(cls, path, name):
+        """Memory-maps a cached split (None if it is not in the cache)."""
+        files = [os.path.join(path, f'{name}_{part}.npy') for part in ('targets', 'data')]
+        if not all(os.path.exists(file) for file in files):
+            return None
+        targets, data = [torch.from_numpy(np.load(file, mmap_mode='c')) for file in files]
+        return cls(data, targets)
+
+    def save(self, path, name):
+        os.makedirs(path, exist_ok=True)
+        # The data file is written last, so that it marks the entry as complete
+        for part, t in (('targets', self.targets), ('data', self.data)):
+            file = os.path.join(path, f'{name}_{part}.npy')
+            tmp = f'{file}.{os.getpid()}.tmp.npy'
+            np.save(tmp, t.cpu().numpy())
+            os.replace(tmp, file)
+
+    def __getitem__(self, item):
+        return self.data[item], self.targets[item]
+
+    def __len__(self):
+        return self.data.size(0)
+
+
+class TensorBuffer:
+    """
+    Buffer of examples kept as one contiguous tensor of images and one of targets. It can be used wherever
+    contflame's Buffer is: indexing gives (image, target) pairs, slicing gives views, + concatenates.
+    """
+
+    def __init__(self, imgs, trgs):
+        self.imgs = imgs.contiguous()
+        self.trgs = trgs.contiguous()
+
+    @classmethod
+    def from_dataset(cls, ds, dim):
+        """dim examples of ds chosen by reservoir sampling (the same ones Buffer(ds, dim) would keep), all of them if dim < 0."""
+        idx = list(range(len(ds) if dim < 0 else min(dim, len(ds))))
+        for i in range(len(idx), len(ds)):
+            h = random.randint(0, i)
+            if h < dim:
+                idx[h] = i
+
+        if isinstance(ds, TensorSplit):
+            idx = torch.tensor(idx, dtype=torch.long)
+            return cls(ds.data[idx], ds.targets[idx])
+        imgs, trgs = zip(*(ds[i] for i in idx))
+        return cls(torch.stack(imgs), torch.stack([torch.as_tensor(t) for t in trgs]))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return TensorBuffer(self.imgs[item], self.trgs[item])
+        return self.imgs[item], self.trgs[item]
+
+    def __len__(self):
+        return self.imgs.size(0)
+
+    def __add__(self, buffer):
+        imgs, trgs = buffer_to_tensors(buffer)
+        return TensorBuffer(torch.cat((self.imgs, imgs)), torch.cat((self.trgs, trgs)))
+
+    def sample(self, n):
+        """Random minibatch of n examples (without replacement)."""
+        idx = torch.randperm(len(self))[:n]
+        return self.imgs[idx], self.trgs[idx]
+
+
+class ReplayLoader:
+    """
+    Fused replacement of MultiLoader([trainset] + memories): the memories are stacked into one tensor store and
+    the replay portion of every minibatch is drawn with a single indexing op. Each memory contributes its examples
+    in a random order, repeating them evenly when its share of the minibatch is larger than the memory.
+    The composition of the minibatches of batch_size samples is set by param_config['replay_policy'] (see replay_split).
+    """
+
+    def __init__(self, trainset, memories, batch_size, config):
+        param_config = config['param_config']
+        self.codec = MemoryCodec.from_config(config)
+        self.train_size, self.quotas = replay_split(batch_size, len(memories), param_config)
+        self.train_loader = make_loader(trainset, self.train_size, True, config)
+        self.no_steps = (len(trainset) + self.train_size - 1) // self.train_size
+
+        # Memory store, on the device with the current task data when it is pre-tensorized
+        store_device = config['run_config']['device'] if isinstance(trainset, TensorSplit) else 'cpu'
+        self.imgs = self.trgs = None
+        if memories:
+            imgs, trgs = zip(*(buffer_to_tensors(memory) for memory in memories))
+            self.imgs, self.trgs = torch.cat(imgs).to(store_device), torch.cat(trgs).to(store_device)
+
+            lens = torch.tensor([len(memory) for memory in memories])
+            offsets = torch.cumsum(lens, 0) - lens
+            quotas = torch.tensor(self.quotas)
+            # Segment of every stored example, and position of every replayed example in the shuffled store
+            self.segments = torch.repeat_interleave(torch.arange(len(memories)), lens).to(store_device)
+            self.positions = torch.cat([offset + torch.arange(quota) % length for offset, quota, length in zip(offsets, quotas, lens)]).to(store_device)
+            if param_config['replay_policy'] == 'even':
+                # As MultiLoader, an epoch covers every memory too (bounded policies: only the current task)
+                self.no_steps = max([self.no_steps] + [(length + quota - 1) // quota for length, quota in zip(lens.tolist(), quotas.tolist()) if quota > 0])
+
+    def __iter__(self):
+        train_iter = iter(self.train_loader)
+
+        for _ in range(self.no_steps):
+            # Current task portion (always full: a pass that ends is completed with the next one)
+            x = y = None
+            while x is None or x.size(0) < self.train_size:
+                try:
+                    inp, out = next(train_iter)
+                except StopIteration:
+                    train_iter = iter(self.train_loader)
+                    continue
+                x = inp if x is None else torch.cat((x, inp))
+                y = out if y is None else torch.cat((y, out))
+            x, y = x[:self.train_size], y[:self.train_size]
+
+            if self.imgs is not None:
+                # Shuffle every memory within its segment of the store, then take each one's share
+                perm = (torch.rand(self.segments.size(0), device=self.segments.device) + self.segments).argsort()
+                idx = perm[self.positions]
+                x = torch.cat((x, self.codec.decode(self.imgs[idx].to(x.device))))
+                y = torch.cat((y, self.trgs[idx].to(y.device)))
+
+            yield x, y
+
+    def __len__(self):
+        return self.no_steps
+
+
+def replay_split(batch_size, n_memories, param_config):
+    """
+    Samples of the current task and of each memory in a minibatch of batch_size samples, by replay policy:
+    'even' splits it evenly between the current task and each memory (as MultiLoader), 'ratio' gives a fixed
+    'replay_ratio' of it to the memories and 'quota' gives 'replay_quota' samples to each memory (at most
+    'replay_ratio' of it in total). In both bounded policies the current task share does not shrink with the tasks.
+    """
+    policy = param_config['replay_policy']
+    if policy == 'even':
+        n = 1 + n_memories
+        sizes = [batch_size // n + 1 if x < batch_size % n else batch_size // n for x in range(n)]
+        return sizes[0], sizes[1:]
+
+    if n_memories == 0:
+        return batch_size, []
+    replay = int(round(batch_size * param_config['replay_ratio']))
+    if policy == 'quota':
+        replay = min(param_config['replay_quota'] * n_memories, replay)
+    elif policy != 'ratio':
+        raise ValueError(f'Unknown replay policy {policy}')
+    replay = min(replay, batch_size - 1)
+
+    quotas = [replay // n_memories + 1 if x < replay % n_memories else replay // n_memories for x in range(n_memories)]
+    return batch_size - replay, quotas
+
+
+class TensorLoader:
+    """Minibatches of a TensorSplit, kept on the device and served by tensor indexing."""
+
+    def __init__(self, dataset, batch_size, shuffle, device):
+        self.data = dataset.data.to(device)
+        self.targets = dataset.targets.to(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        n = self.data.size(0)
+        idx = torch.randperm(n).to(self.data.device) if self.shuffle else None
+
+        for start in range(0, n, self.batch_size):
+            if idx is None:
+                yield self.data[start:start + self.batch_size], self.targets[start:start + self.batch_size]
+            else:
+                batch = idx[start:start + self.batch_size]
+                yield self.data[batch], self.targets[batch]
+
+    def __len__(self):
+        return (self.data.size(0) + self.batch_size - 1) // self.batch_size